@@ -7,10 +7,12 @@ import json
 import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Tuple, Optional
 
 import numpy as np
-from tifffile import imread, TiffFile, TiffWriter
+from numba import njit, prange
+from tifffile import TiffFile, TiffWriter
 
 from . import utils
 
@@ -21,6 +23,14 @@ except ImportError:
     ScanImageTiffReader = None
     HAS_SCANIMAGE = False
 
+# tifffile decodes pages/strips on a thread pool and its codecs release the
+# GIL, so batch decode scales across cores on the tifffile read path
+TIFF_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+# output directories already created by generate_tiff_filename, so writing
+# thousands of registered tiffs stats each directory only once
+_created_dirs = set()
+
 
 def generate_tiff_filename(functional_chan: int, align_by_chan: int, save_path: str,
                            k: int, ichan: bool) -> str:
@@ -58,8 +68,9 @@ def generate_tiff_filename(functional_chan: int, align_by_chan: int, save_path:
         else:
             tifroot = os.path.join(save_path, "reg_tif")
             wchan = 0
-    if not os.path.isdir(tifroot):
-        os.makedirs(tifroot)
+    if tifroot not in _created_dirs:
+        os.makedirs(tifroot, exist_ok=True)
+        _created_dirs.add(tifroot)
     fname = "file00%0.3d_chan%d.tif" % (k, wchan)
     fname = os.path.join(tifroot, fname)
     return fname
@@ -77,9 +88,14 @@ def save_tiff(mov: np.ndarray, fname: str) -> None:
         The tiff filename to save to
 
     """
+    if mov.dtype.kind in "iu":
+        # registration output is already integer-valued, no need to floor
+        stack = mov.astype(np.int16, copy=False)
+    else:
+        stack = np.floor(mov).astype(np.int16)
     with TiffWriter(fname) as tif:
-        for frame in np.floor(mov).astype(np.int16):
-            tif.write(frame, contiguous=True)
+        # tifffile writes the pages of a 3D stack internally
+        tif.write(stack, contiguous=True)
 
 
 def open_tiff(file: str,
@@ -88,6 +104,11 @@ def open_tiff(file: str,
     if sktiff:
         tif = TiffFile(file)
         Ltif = len(tif.pages)
+        try:
+            # hint sequential access for page-ordered batch reads
+            utils.advise_sequential(tif.filehandle._fh)
+        except (AttributeError, OSError):
+            pass
     else:
         tif = ScanImageTiffReader(file)
         Ltif = 1 if len(tif.shape()) < 3 else tif.shape()[0]  # single page tiffs
@@ -96,12 +117,21 @@ def open_tiff(file: str,
 
 def use_sktiff_reader(tiff_filename, batch_size: Optional[int] = None) -> bool:
     """Returns False if ScanImageTiffReader works on the tiff file, else True (in which case use tifffile)."""
+    try:
+        with TiffFile(tiff_filename) as tif:
+            if tif.pages[0].bitspersample == 12:
+                # 12-bit-packed camera tiffs; ScanImageTiffReader cannot
+                # decode these, tifffile unpacks them to uint16
+                print("NOTE: 12-bit tiff, using tifffile")
+                return True
+    except Exception:
+        pass
     if HAS_SCANIMAGE:
         try:
             with ScanImageTiffReader(tiff_filename) as tif:
-                tif.data() if len(tif.shape()) < 3 else tif.data(
-                    beg=0, end=np.minimum(batch_size,
-                                          tif.shape()[0] - 1))
+                # decoding a single frame is enough to tell whether the
+                # reader handles this tiff; a full batch would be thrown away
+                tif.data() if len(tif.shape()) < 3 else tif.data(beg=0, end=1)
             return False
         except:
             print(
@@ -112,26 +142,126 @@ def use_sktiff_reader(tiff_filename, batch_size: Optional[int] = None) -> bool:
         print("NOTE: ScanImageTiffReader not installed, using tifffile")
         return True
 
-def read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff):
+class MemmapWriter:
+    """ Append-style binary writer backed by numpy.memmap.
+
+    Batches are assigned into a memory-mapped window instead of issuing one
+    write syscall per batch, so the page cache coalesces the stores and
+    writes them back asynchronously. The file is grown in large chunks
+    (total frame counts are not known up front) and truncated to its true
+    length on close. Wraps a file opened "w+b" and mimics its
+    write/close interface.
+    """
+    CHUNK_BYTES = 1 << 30
+
+    def __init__(self, fid):
+        self.fid = fid
+        self.mm = None
+        self.offset = 0  # next byte to write
+        self.mapped = 0  # end of the currently allocated region
+
+    def write(self, data):
+        data = np.frombuffer(data, np.uint8)
+        pos = 0
+        while pos < data.size:
+            if self.offset >= self.mapped:
+                self._advance()
+            chunk_start = self.mapped - self.mm.size
+            n = min(self.mapped - self.offset, data.size - pos)
+            self.mm[self.offset - chunk_start:self.offset - chunk_start + n] = \
+                data[pos:pos + n]
+            self.offset += n
+            pos += n
+
+    def _advance(self):
+        if self.mm is not None:
+            self.mm.flush()
+        chunk_start = self.mapped
+        self.mapped += self.CHUNK_BYTES
+        os.ftruncate(self.fid.fileno(), self.mapped)
+        self.mm = np.memmap(self.fid, dtype=np.uint8, mode="r+",
+                            offset=chunk_start, shape=(self.CHUNK_BYTES,))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm = None
+            os.ftruncate(self.fid.fileno(), self.offset)
+        self.fid.close()
+
+
+def accumulate_mean_f32(dst, src, divide_by=None):
+    """ Accumulates the sum over frames of `src` into the float32 `dst`
+    without materializing a float32 (or, via `.mean`, float64) copy of the
+    batch; pass `divide_by` to accumulate the batch mean instead. """
+    s = np.add.reduce(src, axis=0, dtype=np.float32)
+    if divide_by is not None:
+        s /= divide_by
+    dst += s
+
+
+def write_frames(fid, im):
+    """ Writes an array to an open binary file with zero-copy buffering.
+    `bytearray(im)` would allocate a full mutable copy of the batch first;
+    a memoryview hands the array's own buffer to the file, so only
+    non-contiguous strided slices still need one contiguity copy.
+    Empty batches (a plane with no frames in a ragged trailing batch)
+    write nothing: a zero-sized view cannot be cast to bytes. """
+    if im.size == 0:
+        return
+    if not im.flags["C_CONTIGUOUS"]:
+        im = np.ascontiguousarray(im)
+    fid.write(memoryview(im).cast("b"))
+
+
+def alloc_batch_buffer(tif, Ltif, batch_size, use_sktiff, buf=None):
+    """ Preallocates a reusable batch read buffer matching the tiff's frame shape and dtype.
+    Returns `buf` unchanged if it is already compatible, so callers can reuse one
+    buffer across files instead of reallocating a multi-MB array per batch. """
+    if use_sktiff:
+        page = tif.pages[0]
+        shape, dtype = tuple(page.shape), np.dtype(page.dtype)
+    else:
+        shape = tuple(tif.shape()[-2:])
+        dtype = np.dtype(tif.dtype())
+    nbuf = min(batch_size, Ltif)
+    if (buf is not None and buf.dtype == dtype and buf.shape[0] >= nbuf and
+            buf.shape[1:] == shape):
+        return buf
+    return np.empty((nbuf,) + shape, dtype)
+
+def read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff, out=None):
     # tiff reading
     if ix >= Ltif:
         return None
     nfr = min(Ltif - ix, batch_size)
     if use_sktiff:
-        im = imread(file, key=range(ix, ix + nfr))
+        if out is not None and nfr > 1:
+            im = tif.asarray(key=range(ix, ix + nfr), out=out[:nfr],
+                        maxworkers=TIFF_DECODE_WORKERS)
+        else:
+            im = tif.asarray(key=range(ix, ix + nfr), maxworkers=TIFF_DECODE_WORKERS)
     elif Ltif == 1:
         im = tif.data()
     else:
         im = tif.data(beg=ix, end=ix + nfr)
+        if out is not None and im.shape == out[:nfr].shape and im.dtype == out.dtype:
+            np.copyto(out[:nfr], im)
+            im = out[:nfr]
     # for single-page tiffs, add 1st dim
     if len(im.shape) < 3:
         im = np.expand_dims(im, axis=0)
 
-    # check if uint16
+    # halve uint16/int32 into int16 range with a shift instead of a divide
     if im.dtype.type == np.uint16:
-        im = (im // 2).astype(np.int16)
+        if im.flags.writeable:
+            im = np.right_shift(im, 1, out=im).view(np.int16)
+        else:
+            im = (im >> 1).view(np.int16)
     elif im.dtype.type == np.int32:
-        im = (im // 2).astype(np.int16)
+        halved = np.empty(im.shape, np.int16)
+        np.right_shift(im, 1, out=halved, casting="unsafe")
+        im = halved
     elif im.dtype.type != np.int16:
         im = im.astype(np.int16)
 
@@ -140,6 +270,33 @@ def read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff):
 
     return im
 
+def read_single_page_int16(file):
+    """ Reads a single-page tiff and halves uint16 into int16 (thread-safe,
+    used for concurrent reads of single-page ome stacks). """
+    if HAS_SCANIMAGE:
+        with ScanImageTiffReader(file) as tif:
+            im = tif.data()
+    else:
+        with TiffFile(file) as tif:
+            im = tif.pages[0].asarray()
+    if im.dtype.type == np.uint16:
+        if im.flags.writeable:
+            return np.right_shift(im, 1, out=im).view(np.int16)
+        return (im >> 1).view(np.int16)
+    return im.astype(np.int16, copy=False)
+
+
+def bruker_plane_frames(im, plane_order, nplanes):
+    """ Routes each frame position of a bruker batch to its recorded fov.
+
+    `plane_order` holds the fov id of each frame position in the file; fov
+    ids are not necessarily recorded in 0,1,... order, so frames are routed
+    by position, not by id. Yields (iplane, frames) pairs in file order.
+    """
+    for pos, iplane in enumerate(plane_order):
+        yield int(iplane), (im[pos:pos + 1, :, :] if nplanes > 1 else im)
+
+
 def tiff_to_binary(ops):
     """  finds tiff files and writes them to binaries
 
@@ -169,6 +326,9 @@ def tiff_to_binary(ops):
 
     # open all binary files for writing and look for tiffs in all requested folders
     ops1, fs, reg_file, reg_file_chan2 = utils.find_files_open_binaries(ops1, False)
+    # map the output binaries so batch writes go through the page cache
+    reg_file = [MemmapWriter(f) for f in reg_file]
+    reg_file_chan2 = [MemmapWriter(f) for f in reg_file_chan2]
     isbruker = ops1[0]['bruker']
     recpath  = ops1[0]['save_path0']
     ops      = ops1[0]
@@ -185,118 +345,157 @@ def tiff_to_binary(ops):
     if ~isbruker:
         batch_size = nplanes * nchannels * math.ceil(batch_size / (nplanes * nchannels))
 
+    # initialize per-plane accumulators once from the first tiff's frame shape
+    # so the hot loop carries no first-batch branch
+    tif0, _ = open_tiff(fs[0], use_sktiff)
+    if use_sktiff:
+        Ly, Lx = tif0.pages[0].shape
+    else:
+        Ly, Lx = tif0.shape()[-2:]
+    tif0.close()
+    for j in range(0, nplanes):
+        ops1[j]["nframes"] = 0
+        ops1[j]["frames_per_file"] = np.zeros((len(fs),), dtype=int)
+        ops1[j]["meanImg"] = np.zeros((Ly, Lx), np.float32)
+        if nchannels > 1:
+            ops1[j]["meanImg_chan2"] = np.zeros((Ly, Lx), np.float32)
+    nfunc = ops["functional_chan"] - 1 if nchannels > 1 else 0
+    stride = nplanes * nchannels
+
     # loop over all tiffs
     which_folder = -1
     ntotal = 0
     plane_ct = np.zeros(nplanes)
-    
-    for ik, file in enumerate(fs):
-        # open tiff
-        # print('opening file {}'.format(file))
-        tif, Ltif = open_tiff(file, use_sktiff)
-        # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-        if isbruker:
-            plane_order = frameinfo['fov_ids'][(nplanes*ik):(nplanes*ik+nplanes)]
-            # iplane   = frameinfo['fov_ids'][ik] 
-            ichannel = frameinfo['channel_ids'][ik]
-            if ops['first_tiffs'][ik]:
-                which_folder += 1
- 
-        else:
+    im_bufs = [None, None]
+    demux_buf = None
+    # one reader thread prefetches the next batch while the main thread
+    # converts, accumulates means and writes the current one
+    reader = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        for ik, file in enumerate(fs):
+            # open tiff
+            # print('opening file {}'.format(file))
+            tif, Ltif = open_tiff(file, use_sktiff)
+            for i in range(2):
+                im_bufs[i] = alloc_batch_buffer(tif, Ltif, batch_size, use_sktiff,
+                                                im_bufs[i])
+            if not isbruker and stride > 1 and (
+                    demux_buf is None or demux_buf.shape[2] < batch_size // stride or
+                    demux_buf.shape[3:] != im_bufs[0].shape[1:]):
+                demux_buf = np.empty((nplanes, nchannels, batch_size // stride) +
+                                     im_bufs[0].shape[1:], np.int16)
             # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-            plane_order = [0]
-            if ops['first_tiffs'][ik]:
-                which_folder += 1
-                iplane = 0
-
-        # ix = iplane
-
-        ix = 0
-        # plane_idx = 0
-        while 1:
-            # tiff reading
-            im = read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff)
-            if im is None:
-                break
-
+            if isbruker:
+                plane_order = frameinfo['fov_ids'][(nplanes*ik):(nplanes*ik+nplanes)]
+                # iplane   = frameinfo['fov_ids'][ik] 
+                ichannel = frameinfo['channel_ids'][ik]
+                if ops['first_tiffs'][ik]:
+                    which_folder += 1
+ 
+            else:
+                # keep track of the plane identity of the first frame (channel identity is assumed always 0)
+                plane_order = [0]
+                if ops['first_tiffs'][ik]:
+                    which_folder += 1
+                    iplane = 0
 
-            nframes = im.shape[0]
-            # nframes = im.shape[0] / Ltif if Ltif > 0 else im.shape[0]
-            for plane_idx in plane_order:
-                iplane = plane_order[plane_idx] if isbruker else iplane
+            # ix = iplane
 
-                if nplanes > 1:
-                    current_im = im[plane_idx:plane_idx+1, :, :]
-                else:
-                    current_im = im
+            ix = 0
+            slot = 0
+            pending = reader.submit(read_tiff, file, tif, Ltif, ix, batch_size,
+                                    use_sktiff, out=im_bufs[slot])
+            # plane_idx = 0
+            while 1:
+                # tiff reading
+                im = pending.result()
+                if im is None:
+                    break
 
+                nframes = im.shape[0]
+                # prefetch the next batch into the other buffer
+                slot = 1 - slot
+                pending = reader.submit(read_tiff, file, tif, Ltif, ix + nframes,
+                                        batch_size, use_sktiff, out=im_bufs[slot])
+                # nframes = im.shape[0] / Ltif if Ltif > 0 else im.shape[0]
                 if isbruker:
-                    if plane_ct[iplane]==0:
-                        ops1[iplane]['nframes'] = 0
-                        ops1[iplane]['frames_per_file'] = np.zeros((len(fs),), dtype=int)
-                        ops1[iplane]['meanImg'] = np.zeros((current_im.shape[1], current_im.shape[2]), np.float32)
-
-                        # This if block is not debugged yet
+                    for iplane, current_im in bruker_plane_frames(
+                            im, plane_order, nplanes):
+                        # Multi-channel not yet fixed for 2 planes
                         if nchannels>1:
-                            ops1[iplane]['meanImg_chan2'] = np.zeros((im.shape[1], im.shape[2]), np.float32)
-
-                    # Multi-channel not yet fixed for 2 planes
-                    if nchannels>1:
-                        if ichannel == ops['functional_chan']:
-                            reg_file[iplane].write(bytearray(im))
-                            ops1[iplane]['meanImg'] += im.astype(np.float32).sum(axis=0)
-                            ops1[iplane]['nframes'] += im.shape[0]
-                            ops1[iplane]['frames_per_file'][int(plane_ct[iplane])] += im.shape[0]
-                            ops1[iplane]['frames_per_folder'][which_folder] += im.shape[0]
+                            if ichannel == ops['functional_chan']:
+                                write_frames(reg_file[iplane], im)
+                                accumulate_mean_f32(ops1[iplane]['meanImg'], im)
+                                ops1[iplane]['nframes'] += im.shape[0]
+                                ops1[iplane]['frames_per_file'][int(plane_ct[iplane])] += im.shape[0]
+                                ops1[iplane]['frames_per_folder'][which_folder] += im.shape[0]
     
-                        else:
-                            reg_file_chan2[iplane].write(bytearray(im))
-                            ops1[iplane]['meanImg_chan2'] += im.mean(axis=0)
+                            else:
+                                write_frames(reg_file_chan2[iplane], im)
+                                accumulate_mean_f32(ops1[iplane]['meanImg_chan2'], im, divide_by=im.shape[0])
 
-                    else:
-                        reg_file[iplane].write(bytearray(current_im))
-                        ops1[iplane]['meanImg'] += current_im.astype(np.float32).sum(axis=0)
-                        ops1[iplane]['nframes'] += current_im.shape[0]
-                        # ops1[iplane]['frames_per_file'][int(plane_ct[iplane])] += current_im.shape[0]
-                        ops1[iplane]['frames_per_file'][ik] += current_im.shape[0]
-                        ops1[iplane]['frames_per_folder'][which_folder] += current_im.shape[0]
+                        else:
+                            write_frames(reg_file[iplane], current_im)
+                            accumulate_mean_f32(ops1[iplane]['meanImg'], current_im)
+                            ops1[iplane]['nframes'] += current_im.shape[0]
+                            # ops1[iplane]['frames_per_file'][int(plane_ct[iplane])] += current_im.shape[0]
+                            ops1[iplane]['frames_per_file'][ik] += current_im.shape[0]
+                            ops1[iplane]['frames_per_folder'][which_folder] += current_im.shape[0]
                     
-                    plane_ct[iplane] += current_im.shape[0] # assumes each tif "stack" is from single plane
+                        plane_ct[iplane] += current_im.shape[0] # assumes each tif "stack" is from single plane
 
                 else:
+                    n_cycles = nframes // stride
+                    # the carried phase goes fractional when a file's frame
+                    # count is not divisible by nchannels; the whole-cycle
+                    # transpose demux only holds for an integral phase, so
+                    # fractional batches take the strided fallback with the
+                    # original int(nchannels * phase) start index
+                    if (stride > 1 and n_cycles * stride == nframes and
+                            float(iplane).is_integer()):
+                        # demultiplex the whole interleaved batch with one
+                        # transpose pass so every per-plane block is
+                        # contiguous for the write and the reduction
+                        im5 = demux_buf[:, :, :n_cycles]
+                        im5[:] = im.reshape(n_cycles, nplanes, nchannels,
+                                            im.shape[1],
+                                            im.shape[2]).transpose(1, 2, 0, 3, 4)
+                    else:
+                        im5 = None
                     for j in range(0, nplanes):
-                        if ik == 0 and ix == 0:
-                            ops1[j]["nframes"] = 0
-                            ops1[j]["frames_per_file"] = np.zeros((len(fs),), dtype=int)
-                            ops1[j]["meanImg"] = np.zeros((im.shape[1], im.shape[2]),
-                                                        np.float32)
-                            if nchannels > 1:
-                                ops1[j]["meanImg_chan2"] = np.zeros((im.shape[1], im.shape[2]),
-                                                                    np.float32)
-                        i0 = nchannels * ((iplane + j) % nplanes)
-                        if nchannels > 1:
-                            nfunc = ops["functional_chan"] - 1
+                        if im5 is not None:
+                            ip = int(iplane + j) % nplanes
+                            im2write = im5[ip, nfunc]
                         else:
-                            nfunc = 0
-                        im2write = im[int(i0) + nfunc:nframes:nplanes * nchannels]
+                            i0 = int(nchannels * ((iplane + j) % nplanes))
+                            im2write = im[i0 + nfunc:nframes:stride]
 
-                        reg_file[j].write(bytearray(im2write))
-                        ops1[j]["meanImg"] += im2write.astype(np.float32).sum(axis=0)
+                        write_frames(reg_file[j], im2write)
+                        accumulate_mean_f32(ops1[j]["meanImg"], im2write)
                         ops1[j]["nframes"] += im2write.shape[0]
                         ops1[j]["frames_per_file"][ik] += im2write.shape[0]
                         ops1[j]["frames_per_folder"][which_folder] += im2write.shape[0]
                         #print(ops1[j]["frames_per_folder"][which_folder])
                         if nchannels > 1:
-                            im2write = im[int(i0) + 1 - nfunc:nframes:nplanes * nchannels]
-                            reg_file_chan2[j].write(bytearray(im2write))
-                            ops1[j]["meanImg_chan2"] += im2write.mean(axis=0)
+                            if im5 is not None:
+                                im2write = im5[ip, 1 - nfunc]
+                            else:
+                                im2write = im[i0 + 1 - nfunc:nframes:stride]
+                            write_frames(reg_file_chan2[j], im2write)
+                            accumulate_mean_f32(ops1[j]["meanImg_chan2"], im2write, divide_by=im2write.shape[0])
                     iplane = (iplane - nframes / nchannels) % nplanes
                 
-            ix += nframes
-            ntotal += nframes
-            if ntotal % (batch_size * 4) == 0:
-                print("%d frames of binary, time %0.2f sec." %
-                    (ntotal, time.time() - t0))
+                ix += nframes
+                ntotal += nframes
+                if ntotal % (batch_size * 4) == 0:
+                    print("%d frames of binary, time %0.2f sec." %
+                        (ntotal, time.time() - t0))
+    finally:
+        # shut the prefetch thread down on failures too, so a bad
+        # tiff mid-run cannot leak the executor or an in-flight
+        # read into a shared buffer
+        reader.shutdown()
     gc.collect()
     # write ops files
     do_registration = ops["do_registration"]
@@ -316,6 +515,21 @@ def tiff_to_binary(ops):
     return ops1[0]
 
 
+@njit(parallel=True)
+def _demux_plane(im, i0, step, y0, y1, out, acc):
+    """ Copies the strided frames of one mesoscope line block into `out`
+    (contiguous) while accumulating their sum into the float32 `acc`,
+    in a single threaded pass over the batch. """
+    nout = out.shape[0]
+    Lx = im.shape[2]
+    for y in prange(y1 - y0):
+        for t in range(nout):
+            for x in range(Lx):
+                v = im[i0 + t * step, y0 + y, x]
+                out[t, y, x] = v
+                acc[y, x] += v
+
+
 def mesoscan_to_binary(ops):
     """ finds mesoscope tiff files and writes them to binaries
 
@@ -381,6 +595,9 @@ def mesoscan_to_binary(ops):
     # open all binary files for writing
     # look for tiffs in all requested folders
     ops1, fs, reg_file, reg_file_chan2 = utils.find_files_open_binaries(ops1, False)
+    # map the output binaries so batch writes go through the page cache
+    reg_file = [MemmapWriter(f) for f in reg_file]
+    reg_file_chan2 = [MemmapWriter(f) for f in reg_file_chan2]
     ops = ops1[0]
 
     nchannels = ops1[0]["nchannels"]
@@ -393,71 +610,112 @@ def mesoscan_to_binary(ops):
     # loop over all tiffs
     which_folder = -1
     ntotal = 0
-    for ik, file in enumerate(fs):
-        # open tiff
-        tif, Ltif = open_tiff(file, use_sktiff)
-        if ops["first_tiffs"][ik]:
-            which_folder += 1
-            iplane = 0
-        ix = 0
-        while 1:
-            if ix >= Ltif:
-                break
-            nfr = min(Ltif - ix, batch_size)
-            if use_sktiff:
-                im = imread(file, key=range(ix, ix + nfr))
-            else:
+    im_bufs = [None, None]
+    # frames interleave over physical planes only; ROIs share frames via lines
+    stride = nplanes * nchannels
+    plane_bufs = [None] * ops["nplanes"]
+    # one reader thread prefetches the next batch while the main thread
+    # slices planes, accumulates means and writes the current one
+    reader = ThreadPoolExecutor(max_workers=1)
+    try:
+        for ik, file in enumerate(fs):
+            # open tiff
+            tif, Ltif = open_tiff(file, use_sktiff)
+            for i in range(2):
+                im_bufs[i] = alloc_batch_buffer(tif, Ltif, batch_size, use_sktiff,
+                                                im_bufs[i])
+
+            def read_raw(ix, out):
+                if ix >= Ltif:
+                    return None
+                nfr = min(Ltif - ix, batch_size)
+                if use_sktiff:
+                    if nfr > 1:
+                        return tif.asarray(key=range(ix, ix + nfr), out=out[:nfr],
+                            maxworkers=TIFF_DECODE_WORKERS)
+                    return tif.asarray(key=range(ix, ix + nfr), maxworkers=TIFF_DECODE_WORKERS)
                 if Ltif == 1:
-                    im = tif.data()
-                else:
-                    im = tif.data(beg=ix, end=ix + nfr)
-            if im.size == 0:
-                break
-
-            if len(im.shape) < 3:
-                im = np.expand_dims(im, axis=0)
-
-            if im.shape[0] > nfr:
-                im = im[:nfr, :, :]
-            nframes = im.shape[0]
-
-            for j in range(0, ops["nplanes"]):
-                jlines = np.array(ops1[j]["lines"]).astype(np.int32)
-                jplane = ops1[j]["iplane"]
-                if ik == 0 and ix == 0:
-                    ops1[j]["meanImg"] = np.zeros((len(jlines), im.shape[2]),
-                                                  np.float32)
+                    return tif.data()
+                im = tif.data(beg=ix, end=ix + nfr)
+                if im.shape == out[:nfr].shape and im.dtype == out.dtype:
+                    np.copyto(out[:nfr], im)
+                    im = out[:nfr]
+                return im
+
+            if ops["first_tiffs"][ik]:
+                which_folder += 1
+                iplane = 0
+            ix = 0
+            slot = 0
+            pending = reader.submit(read_raw, ix, im_bufs[slot])
+            while 1:
+                im = pending.result()
+                if im is None or im.size == 0:
+                    break
+
+                if len(im.shape) < 3:
+                    im = np.expand_dims(im, axis=0)
+
+                nfr = min(Ltif - ix, batch_size)
+                if im.shape[0] > nfr:
+                    im = im[:nfr, :, :]
+                nframes = im.shape[0]
+                # prefetch the next batch into the other buffer
+                slot = 1 - slot
+                pending = reader.submit(read_raw, ix + nframes, im_bufs[slot])
+
+                for j in range(0, ops["nplanes"]):
+                    jlines = np.array(ops1[j]["lines"]).astype(np.int32)
+                    jplane = ops1[j]["iplane"]
+                    if ik == 0 and ix == 0:
+                        ops1[j]["meanImg"] = np.zeros((len(jlines), im.shape[2]),
+                                                      np.float32)
+                        if nchannels > 1:
+                            ops1[j]["meanImg_chan2"] = np.zeros((len(jlines), im.shape[2]),
+                                                                np.float32)
+                        ops1[j]["nframes"] = 0
+                        plane_bufs[j] = np.empty(
+                            ((batch_size + stride - 1) // stride, len(jlines),
+                             im.shape[2]), im.dtype)
+                    i0 = int(nchannels * ((iplane + jplane) % nplanes))
                     if nchannels > 1:
-                        ops1[j]["meanImg_chan2"] = np.zeros((len(jlines), im.shape[2]),
-                                                            np.float32)
-                    ops1[j]["nframes"] = 0
-                i0 = nchannels * ((iplane + jplane) % nplanes)
-                if nchannels > 1:
-                    nfunc = ops["functional_chan"] - 1
-                else:
-                    nfunc = 0
-                #frange = np.arange(int(i0)+nfunc, nframes, nplanes*nchannels)
-                im2write = im[int(i0) + nfunc:nframes:nplanes * nchannels,
-                              jlines[0]:(jlines[-1] + 1), :]
-                #im2write = im[np.ix_(frange, jlines, np.arange(0,im.shape[2],1,int))]
-                ops1[j]["meanImg"] += im2write.astype(np.float32).sum(axis=0)
-                reg_file[j].write(bytearray(im2write))
-                ops1[j]["nframes"] += im2write.shape[0]
-                ops1[j]["frames_per_folder"][which_folder] += im2write.shape[0]
-                if nchannels > 1:
-                    frange = np.arange(
-                        int(i0) + 1 - nfunc, nframes, nplanes * nchannels)
-                    im2write = im[np.ix_(frange, jlines,
-                                         np.arange(0, im.shape[2], 1, int))]
-                    reg_file_chan2[j].write(bytearray(im2write))
-                    ops1[j]["meanImg_chan2"] += im2write.astype(np.float32).sum(axis=0)
-            iplane = (iplane - nframes / nchannels) % nplanes
-            ix += nframes
-            ntotal += nframes
-            if ops1[0]["nframes"] % (batch_size * 4) == 0:
-                print("%d frames of binary, time %0.2f sec." %
-                      (ops1[0]["nframes"], time.time() - t0))
-        gc.collect()
+                        nfunc = ops["functional_chan"] - 1
+                    else:
+                        nfunc = 0
+                    # fused demux + mean accumulation: one threaded pass copies the
+                    # line block contiguously and sums it into meanImg
+                    nout = len(range(i0 + nfunc, nframes, stride))
+                    if nout > 0:
+                        im2write = plane_bufs[j][:nout]
+                        _demux_plane(im, i0 + nfunc, stride, int(jlines[0]),
+                                     int(jlines[-1]) + 1, im2write, ops1[j]["meanImg"])
+                        write_frames(reg_file[j], im2write)
+                    ops1[j]["nframes"] += nout
+                    ops1[j]["frames_per_folder"][which_folder] += nout
+                    if nchannels > 1:
+                        if int(jlines[-1]) - int(jlines[0]) + 1 == len(jlines):
+                            # mesoscope line blocks are contiguous ascending rows,
+                            # so a plain slice avoids the advanced-indexing copy
+                            im2write = im[i0 + 1 - nfunc:nframes:stride,
+                                          jlines[0]:(jlines[-1] + 1), :]
+                        else:
+                            frange = np.arange(i0 + 1 - nfunc, nframes, stride)
+                            im2write = im[np.ix_(frange, jlines,
+                                                 np.arange(0, im.shape[2], 1, int))]
+                        write_frames(reg_file_chan2[j], im2write)
+                        accumulate_mean_f32(ops1[j]["meanImg_chan2"], im2write)
+                iplane = (iplane - nframes / nchannels) % nplanes
+                ix += nframes
+                ntotal += nframes
+                if ops1[0]["nframes"] % (batch_size * 4) == 0:
+                    print("%d frames of binary, time %0.2f sec." %
+                          (ops1[0]["nframes"], time.time() - t0))
+            gc.collect()
+    finally:
+        # shut the prefetch thread down on failures too, so a bad
+        # tiff mid-run cannot leak the executor or an in-flight
+        # read into a shared buffer
+        reader.shutdown()
     # write ops files
     do_registration = ops["do_registration"]
     for ops in ops1:
@@ -502,6 +760,9 @@ def ome_to_binary(ops):
 
     # open all binary files for writing and look for tiffs in all requested folders
     ops1, fs, reg_file, reg_file_chan2 = utils.find_files_open_binaries(ops1, False)
+    # map the output binaries so batch writes go through the page cache
+    reg_file = [MemmapWriter(f) for f in reg_file]
+    reg_file_chan2 = [MemmapWriter(f) for f in reg_file_chan2]
     ops = ops1[0]
     isbruker = ops1[0]['bruker']
     batch_size = ops["batch_size"]
@@ -571,82 +832,115 @@ def ome_to_binary(ops):
  
     else:
         bruker_bidirectional = ops.get("bruker_bidirectional", False)
-        iplanes = np.arange(0, nplanes)
         if not bruker_bidirectional:
-            iplanes = np.tile(iplanes[np.newaxis, :],
-                            int(np.ceil(len(fs_Ch1) / nplanes))).flatten()
-            iplanes = iplanes[:len(fs_Ch1)]
+            # planes cycle 0,1,...,nplanes-1 over the file list
+            iplanes = np.arange(len(fs_Ch1)) % nplanes
         else:
-            iplanes = np.hstack((iplanes, iplanes[::-1]))
-            iplanes = np.tile(iplanes[np.newaxis, :],
-                            int(np.ceil(len(fs_Ch1) / (2 * nplanes)))).flatten()
-            iplanes = iplanes[:len(fs_Ch1)]
+            # bidirectional scans go up then back down the stack
+            pattern = np.concatenate((np.arange(nplanes), np.arange(nplanes)[::-1]))
+            iplanes = pattern[np.arange(len(fs_Ch1)) % (2 * nplanes)]
 
     itot = 0
-    for ik, file in enumerate(fs_Ch1):
-        ip = iplanes[ik]
-        # read tiff
-        if n_pages==1:    
-            with TiffReader(file) as tif:
-                im = tif.data()  if HAS_SCANIMAGE else tif.pages[0].asarray()
-            if im.dtype.type == np.uint16:
-                im = (im // 2)
-            im = im.astype(np.int16)
-
-            # write to binary
-            ops1[ip]["nframes"] += 1
-            ops1[ip]["frames_per_folder"][0] += 1
-            ops1[ip]["meanImg"] += im.astype(np.float32)
-            reg_file[ip].write(bytearray(im))
-            #gc.collect()
+    im_bufs = [None, None]
+    # one reader thread prefetches the next batch while the main thread
+    # accumulates means and writes the current one
+    reader = ThreadPoolExecutor(max_workers=1)
+    # thousands of tiny single-page files serialize on open/decode latency;
+    # read small groups of them concurrently, writes stay in file order
+    read_chunk = max(8, 2 * (os.cpu_count() or 1))
+    try:
+        if n_pages == 1:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                for ic in range(0, len(fs_Ch1), read_chunk):
+                    files = fs_Ch1[ic:ic + read_chunk]
+                    for ik, im in enumerate(
+                            pool.map(read_single_page_int16, files), start=ic):
+                        ip = iplanes[ik]
+                        # write to binary
+                        ops1[ip]["nframes"] += 1
+                        ops1[ip]["frames_per_folder"][0] += 1
+                        # mixed-type add accumulates int16 -> float32 without a temporary
+                        np.add(ops1[ip]["meanImg"], im, out=ops1[ip]["meanImg"],
+                               casting="unsafe")
+                        write_frames(reg_file[ip], im)
         else:
-            tif, Ltif = open_tiff(file, not HAS_SCANIMAGE)
-            # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-            ix = 0
-            while 1:
-                im = read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff)
-                if im is None:
-                    break          
-                nframes = im.shape[0]
-                ix += nframes
-                itot += nframes
-                reg_file[ip].write(bytearray(im))
-                ops1[ip]["meanImg"] += im.astype(np.float32).sum(axis=0)
-                ops1[ip]["nframes"] += im.shape[0]
-                ops1[ip]["frames_per_file"][ik] += nframes
-                ops1[ip]["frames_per_folder"][0] += nframes
-                if itot % 1000 == 0:
-                    print("%d frames of binary, time %0.2f sec." % (itot, time.time() - t0))
-                gc.collect()            
-
-    if nchannels > 1:
-        itot = 0
-        for ik, file in enumerate(fs_Ch2):
-            ip = iplanes[ik]
-            if n_pages==1:
-                with TiffReader(file) as tif:
-                    im = tif.data() if HAS_SCANIMAGE else tif.pages[0].asarray()
-                if im.dtype.type == np.uint16:
-                    im = (im // 2)
-                im = im.astype(np.int16)
-                ops1[ip]["meanImg_chan2"] += im.astype(np.float32)
-                reg_file_chan2[ip].write(bytearray(im))
-            else:
+            for ik, file in enumerate(fs_Ch1):
+                ip = iplanes[ik]
                 tif, Ltif = open_tiff(file, not HAS_SCANIMAGE)
+                for i in range(2):
+                    im_bufs[i] = alloc_batch_buffer(tif, Ltif, batch_size, use_sktiff,
+                                                    im_bufs[i])
+                # keep track of the plane identity of the first frame (channel identity is assumed always 0)
                 ix = 0
+                slot = 0
+                pending = reader.submit(read_tiff, file, tif, Ltif, ix, batch_size,
+                                        use_sktiff, out=im_bufs[slot])
                 while 1:
-                    im = read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff)
+                    im = pending.result()
                     if im is None:
-                        break          
+                        break
                     nframes = im.shape[0]
+                    # prefetch the next batch into the other buffer
+                    slot = 1 - slot
+                    pending = reader.submit(read_tiff, file, tif, Ltif, ix + nframes,
+                                            batch_size, use_sktiff, out=im_bufs[slot])
                     ix += nframes
                     itot += nframes
-                    ops1[ip]["meanImg_chan2"] += im.astype(np.float32).sum(axis=0)
-                    reg_file_chan2[ip].write(bytearray(im))
+                    write_frames(reg_file[ip], im)
+                    accumulate_mean_f32(ops1[ip]["meanImg"], im)
+                    ops1[ip]["nframes"] += im.shape[0]
+                    ops1[ip]["frames_per_file"][ik] += nframes
+                    ops1[ip]["frames_per_folder"][0] += nframes
                     if itot % 1000 == 0:
                         print("%d frames of binary, time %0.2f sec." % (itot, time.time() - t0))
-                    gc.collect()
+                    gc.collect()            
 
+        if nchannels > 1:
+            itot = 0
+            if n_pages == 1:
+                with ThreadPoolExecutor(max_workers=8) as pool:
+                    for ic in range(0, len(fs_Ch2), read_chunk):
+                        files = fs_Ch2[ic:ic + read_chunk]
+                        for ik, im in enumerate(
+                                pool.map(read_single_page_int16, files), start=ic):
+                            ip = iplanes[ik]
+                            np.add(ops1[ip]["meanImg_chan2"], im,
+                                   out=ops1[ip]["meanImg_chan2"], casting="unsafe")
+                            write_frames(reg_file_chan2[ip], im)
+            else:
+                for ik, file in enumerate(fs_Ch2):
+                    ip = iplanes[ik]
+                    tif, Ltif = open_tiff(file, not HAS_SCANIMAGE)
+                    for i in range(2):
+                        im_bufs[i] = alloc_batch_buffer(tif, Ltif, batch_size,
+                                                        use_sktiff, im_bufs[i])
+                    ix = 0
+                    slot = 0
+                    pending = reader.submit(read_tiff, file, tif, Ltif, ix, batch_size,
+                                            use_sktiff, out=im_bufs[slot])
+                    while 1:
+                        im = pending.result()
+                        if im is None:
+                            break
+                        nframes = im.shape[0]
+                        # prefetch the next batch into the other buffer
+                        slot = 1 - slot
+                        pending = reader.submit(read_tiff, file, tif, Ltif,
+                                                ix + nframes, batch_size, use_sktiff,
+                                                out=im_bufs[slot])
+                        ix += nframes
+                        itot += nframes
+                        accumulate_mean_f32(ops1[ip]["meanImg_chan2"], im)
+                        write_frames(reg_file_chan2[ip], im)
+                        if itot % 1000 == 0:
+                            print("%d frames of binary, time %0.2f sec." % (itot, time.time() - t0))
+                        gc.collect()
+
+    finally:
+        # shut the prefetch thread down on failures too, so a bad
+        # tiff mid-run cannot leak the executor or an in-flight
+        # read into a shared buffer
+        reader.shutdown()
     # write ops files
     do_registration = ops["do_registration"]
     for ops in ops1:
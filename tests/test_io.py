@@ -10,9 +10,11 @@ import numpy as np
 import pytest
 from natsort import natsorted
 from pynwb import NWBHDF5IO
-from suite2p import io
+from suite2p import default_ops, io
 from suite2p.io.nwb import read_nwb, save_nwb
+from suite2p.io.tiff import bruker_plane_frames
 from suite2p.io.utils import get_suite2p_path
+from tifffile import imwrite
 
 
 @pytest.fixture()
@@ -223,3 +225,50 @@ def test_get_suite2p_path(input_path, expected_path, success):
     else:
         with pytest.raises(FileNotFoundError):
             get_suite2p_path(Path(input_path))
+
+
+def test_tiff_to_binary_handles_ragged_trailing_batch(tmp_path):
+    """a page count not divisible by nplanes*nchannels leaves some planes with
+    zero frames in the trailing batch; those must write zero bytes, not crash"""
+    nplanes, npages, Ly, Lx = 3, 10, 8, 6
+    frames = np.arange(npages * Ly * Lx, dtype=np.int16).reshape(npages, Ly, Lx)
+    imwrite(tmp_path.joinpath("input.tif"), frames)
+    ops = default_ops()
+    ops.update(
+        {
+            "data_path": [str(tmp_path)],
+            "save_path0": str(tmp_path),
+            "nplanes": nplanes,
+            "nchannels": 1,
+            "batch_size": nplanes,  # 10 pages -> batches of 3, 3, 3, 1
+        }
+    )
+    op = io.tiff_to_binary(ops)
+    for j in range(nplanes):
+        bin_filename = str(Path(op["save_path0"]).joinpath(
+            f"suite2p/plane{j}/data.bin"))
+        with io.BinaryFile(Ly=op["Ly"], Lx=op["Lx"],
+                           filename=bin_filename) as bin_file:
+            assert np.array_equal(bin_file.data, frames[j::nplanes])
+
+
+def test_bruker_demux_matches_reshape_reference():
+    """demuxed bruker frames are bitwise-equal to a reshape-based reference,
+    with fov ids recorded out of 0,1,... order"""
+    nplanes, ncycles, Ly, Lx = 3, 5, 4, 6
+    fov_ids = np.tile([2, 0, 1], ncycles)
+    frames = np.arange(nplanes * ncycles * Ly * Lx,
+                       dtype=np.int16).reshape(nplanes * ncycles, Ly, Lx)
+    # slow reference: regroup the full interleaved recording by fov id
+    reference = [frames[fov_ids == p] for p in range(nplanes)]
+    # the production demux consumes one file (= one cycle of planes) at a time
+    result = [[] for _ in range(nplanes)]
+    for ik in range(ncycles):
+        im = frames[nplanes * ik:nplanes * (ik + 1)]
+        plane_order = fov_ids[nplanes * ik:nplanes * ik + nplanes]
+        for iplane, chunk in bruker_plane_frames(im, plane_order, nplanes):
+            result[iplane].append(chunk)
+    for p in range(nplanes):
+        demuxed = np.concatenate(result[p])
+        assert demuxed.dtype == reference[p].dtype
+        assert np.array_equal(demuxed, reference[p])